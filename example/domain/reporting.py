@@ -23,13 +23,17 @@ class Client:
 
 class DiagnosticReport:
     @staticmethod
-    def generate(client: Client, listener: EventListener) -> DiagnosticReport:
-        diagnostic_report = DiagnosticReport(client)
+    def generate(
+        client: Client, order_id: str, result: str, listener: EventListener
+    ) -> DiagnosticReport:
+        diagnostic_report = DiagnosticReport(client, order_id, result)
         listener.diagnostic_report_generated(diagnostic_report)
         return diagnostic_report
 
-    def __init__(self, client: Client) -> None:
+    def __init__(self, client: Client, order_id: str, result: str | None) -> None:
         self.client = client
+        self.order_id = order_id
+        self.result = result
 
 
 class AccessDeniedError(Exception):
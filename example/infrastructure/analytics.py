@@ -0,0 +1,162 @@
+import asyncio
+import logging
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+
+import numpy as np
+from aiokafka import AIOKafkaConsumer
+from event_outbox import Event
+from pydantic import ValidationError
+
+from example.domain.rapid_testing import RapidTestResult
+from example.infrastructure.message_queue import ResultChecked
+
+RESULTS = list(RapidTestResult)
+
+
+class PositivityBuckets:
+    def __init__(self, starts: np.ndarray, counts: np.ndarray) -> None:
+        self.starts = starts
+        self.positive = counts[RESULTS.index(RapidTestResult.POSITIVE)]
+        self.negative = counts[RESULTS.index(RapidTestResult.NEGATIVE)]
+        self.invalid = counts[RESULTS.index(RapidTestResult.INVALID)]
+        # Invalid results are not conclusive, so they are not part of the rate
+        conclusive = self.positive + self.negative
+        self.rate = np.divide(
+            self.positive,
+            conclusive,
+            out=np.full(len(starts), np.nan),
+            where=conclusive > 0,
+        )
+
+
+class PositivitySnapshot:
+    def __init__(self, capacity: int = 1024) -> None:
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+        self._results = np.empty(capacity, dtype=np.int8)
+        self._size = 0
+        self._rows: dict[str, int] = {}
+        # Whether every result published before startup has been added
+        self.caught_up = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, order_id: str, checked_at: datetime, result: RapidTestResult) -> None:
+        checked_at_milliseconds = round(checked_at.timestamp() * 1000)
+        # A later result of the same order replaces the earlier one, while
+        # a redelivered earlier result does not
+        row = self._rows.get(order_id)
+        if row is None:
+            if self._size == len(self._timestamps):
+                self._timestamps = np.resize(self._timestamps, 2 * self._size)
+                self._results = np.resize(self._results, 2 * self._size)
+            row = self._rows[order_id] = self._size
+            self._size += 1
+        elif checked_at_milliseconds < self._timestamps[row]:
+            return
+        self._timestamps[row] = checked_at_milliseconds
+        self._results[row] = RESULTS.index(result)
+
+    def buckets(
+        self,
+        start: datetime,
+        end: datetime,
+        bucket: timedelta,
+        window: int = 1,
+    ) -> PositivityBuckets:
+        start_seconds = int(start.timestamp())
+        bucket_seconds = int(bucket.total_seconds())
+        bucket_count = -(-(int(end.timestamp()) - start_seconds) // bucket_seconds)
+
+        timestamps = self._timestamps[: self._size] // 1000
+        results = self._results[: self._size]
+        # Extend the range backwards so the first buckets get a full window
+        first = start_seconds - (window - 1) * bucket_seconds
+        selected = (timestamps >= first) & (
+            timestamps < start_seconds + bucket_count * bucket_seconds
+        )
+        indices = (timestamps[selected] - first) // bucket_seconds
+        total_buckets = bucket_count + window - 1
+        counts = np.bincount(
+            results[selected].astype(np.int64) * total_buckets + indices,
+            minlength=len(RESULTS) * total_buckets,
+        ).reshape(len(RESULTS), total_buckets)
+
+        if window > 1:
+            cumulative = np.cumsum(counts, axis=1)
+            counts = cumulative[:, window - 1 :] - np.pad(
+                cumulative[:, :-window], ((0, 0), (1, 0))
+            )
+
+        starts = start_seconds + np.arange(bucket_count) * bucket_seconds
+        return PositivityBuckets(starts, counts)
+
+
+def run_snapshot_updates(
+    snapshot: PositivitySnapshot, kafka_consumer: AIOKafkaConsumer
+) -> AbstractAsyncContextManager[None]:
+    async def func() -> AsyncIterator[None]:
+        task = asyncio.create_task(_update_snapshot(snapshot, kafka_consumer))
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    return asynccontextmanager(func)()
+
+
+async def _update_snapshot(
+    snapshot: PositivitySnapshot, kafka_consumer: AIOKafkaConsumer
+) -> None:
+    while True:
+        try:
+            await _add_results(snapshot, kafka_consumer)
+        except Exception:
+            logging.getLogger(__name__).critical(
+                "Unexpected exception occurred while updating positivity snapshot",
+                exc_info=True,
+            )
+            await asyncio.sleep(1)
+
+
+async def _add_results(
+    snapshot: PositivitySnapshot, kafka_consumer: AIOKafkaConsumer
+) -> None:
+    while True:
+        batch = await kafka_consumer.getmany(timeout_ms=1000)
+        for records in batch.values():
+            for record in records:
+                _add_result(snapshot, Event.model_validate_json(record.value))
+        if not snapshot.caught_up:
+            snapshot.caught_up = await _caught_up(kafka_consumer)
+
+
+def _add_result(snapshot: PositivitySnapshot, event: Event) -> None:
+    if (event.topic, event.content_schema) != ("rapid_testing", "ResultChecked"):
+        return
+    try:
+        result_checked = ResultChecked.model_validate(event, from_attributes=True)
+    except ValidationError:
+        logging.getLogger(__name__).warning(
+            "Skipped malformed event: %s", event, exc_info=True
+        )
+        return
+    if result_checked.result is not None:
+        snapshot.add(
+            result_checked.order_id,
+            result_checked.occurred_at,
+            result_checked.result,
+        )
+
+
+async def _caught_up(kafka_consumer: AIOKafkaConsumer) -> bool:
+    partitions = kafka_consumer.assignment()
+    if not partitions:
+        return False
+    end_offsets = await kafka_consumer.end_offsets(list(partitions))
+    for partition, end_offset in end_offsets.items():
+        if await kafka_consumer.position(partition) < end_offset:
+            return False
+    return True
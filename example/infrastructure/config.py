@@ -0,0 +1,15 @@
+from pathlib import Path
+
+import dynaconf
+
+settings_path = Path(__file__).parent.parent.parent / "settings"
+config = dynaconf.Dynaconf(
+    environments=True,
+    settings_files=[
+        settings_path / "default.toml",
+        settings_path / "test.toml",
+        settings_path / "local.toml",
+    ],
+    load_dotenv=True,
+    merge_enabled=True,
+)
@@ -1,5 +1,10 @@
+import hashlib
+from collections import Counter
+from typing import Any, Iterable, Mapping
+
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClientSession, AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
 
 from example.domain import booking, rapid_testing, reporting
 
@@ -13,12 +18,35 @@ class Database:
         self.db = db
         self.session = session
 
+    async def create_indexes(self) -> None:
+        for collection in ("rapid_tests", "diagnostic_reports"):
+            indexes = await self.db[collection].index_information(session=self.session)
+            if "order" not in indexes:
+                await self._remove_duplicate_orders(collection)
+            await self.db[collection].create_index(
+                "order_id",
+                name="order",
+                unique=True,
+                session=self.session,
+            )
+
     async def insert_order(self, order: booking.Order) -> None:
         await self.db["orders"].insert_one(
-            {"_id": ObjectId(order.id), "client": order.client.id},
+            {"_id": ObjectId(order.id), "client": order.client.id, "version": 1},
             session=self.session,
         )
 
+    async def insert_orders(self, orders: Iterable[booking.Order]) -> None:
+        documents = [
+            {"_id": ObjectId(order.id), "client": order.client.id, "version": 1}
+            for order in orders
+        ]
+        if documents:
+            await self.db["orders"].insert_many(documents, session=self.session)
+
+    async def get_order_version(self, order_id: ObjectId) -> int | None:
+        return await self._get_version("orders", {"_id": order_id})
+
     async def get_order(self, order_id: ObjectId) -> booking.Order:
         document = await self.db["orders"].find_one(
             {"_id": order_id},
@@ -38,6 +66,7 @@ class Database:
             {
                 "order_id": ObjectId(rapid_test.order.id),
                 "client_id": rapid_test.order.client_id,
+                "version": 1,
             },
             session=self.session,
         )
@@ -51,11 +80,36 @@ class Database:
                     "sample_id": (
                         str(rapid_test.sample.id) if rapid_test.sample else None
                     ),
-                }
+                },
+                "$inc": {"version": 1},
             },
             session=self.session,
         )
 
+    async def upsert_rapid_tests(
+        self, rapid_tests: Iterable[rapid_testing.RapidTest]
+    ) -> None:
+        requests = []
+        for rapid_test in rapid_tests:
+            fields = {"client_id": rapid_test.order.client_id}
+            if rapid_test.result:
+                fields["result"] = str(rapid_test.result)
+            if rapid_test.sample:
+                fields["sample_id"] = str(rapid_test.sample.id)
+            requests.append(
+                UpdateOne(
+                    {"order_id": ObjectId(rapid_test.order.id)},
+                    {"$set": fields, "$inc": {"version": 1}},
+                    upsert=True,
+                )
+            )
+        if requests:
+            await self.db["rapid_tests"].bulk_write(
+                requests,
+                ordered=False,
+                session=self.session,
+            )
+
     async def get_rapid_test_by_order_id(
         self, order_id: ObjectId
     ) -> rapid_testing.RapidTest:
@@ -83,16 +137,41 @@ class Database:
         )
 
     async def insert_diagnostic_report(
-        self,
-        diagnostic_report: reporting.DiagnosticReport,
-        order_id: ObjectId,
+        self, diagnostic_report: reporting.DiagnosticReport
     ) -> None:
-        await self.db["diagnostic_reports"].insert_one(
-            {
-                "order_id": order_id,
-                "client_id": diagnostic_report.client.id,
-            },
-            session=self.session,
+        # A result may be checked again, which generates the report again
+        await self.upsert_diagnostic_reports([diagnostic_report])
+
+    async def upsert_diagnostic_reports(
+        self, diagnostic_reports: Iterable[reporting.DiagnosticReport]
+    ) -> None:
+        requests = [
+            UpdateOne(
+                {"order_id": ObjectId(diagnostic_report.order_id)},
+                {
+                    "$set": {
+                        "client_id": diagnostic_report.client.id,
+                        "result": diagnostic_report.result,
+                    },
+                    "$inc": {"version": 1},
+                },
+                upsert=True,
+            )
+            for diagnostic_report in diagnostic_reports
+        ]
+        if requests:
+            await self.db["diagnostic_reports"].bulk_write(
+                requests,
+                ordered=False,
+                session=self.session,
+            )
+
+    async def get_diagnostic_report_version(
+        self, order_id: ObjectId, client_id: str
+    ) -> int | None:
+        return await self._get_version(
+            "diagnostic_reports",
+            {"order_id": order_id, "client_id": client_id},
         )
 
     async def get_diagnostic_report_by_order_id(
@@ -108,5 +187,227 @@ class Database:
         return reporting.DiagnosticReport(
             client=reporting.Client(
                 client_id=document["client_id"],
+            ),
+            order_id=str(document["order_id"]),
+            result=document.get("result"),
+        )
+
+    async def insert_report_document(self, order_id: ObjectId, content: bytes) -> None:
+        await self.upsert_report_documents({order_id: content})
+
+    async def upsert_report_documents(self, contents: Mapping[ObjectId, bytes]) -> None:
+        if not contents:
+            return
+        # Documents are content-addressed, so identical renders are stored once
+        content_hashes = {
+            order_id: hashlib.sha256(content).hexdigest()
+            for order_id, content in contents.items()
+        }
+        await self.db["report_documents"].bulk_write(
+            [
+                UpdateOne(
+                    {"_id": content_hashes[order_id]},
+                    {"$setOnInsert": {"content": content}},
+                    upsert=True,
+                )
+                for order_id, content in contents.items()
+            ],
+            ordered=False,
+            session=self.session,
+        )
+        await self.db["diagnostic_reports"].bulk_write(
+            [
+                UpdateOne(
+                    {"order_id": order_id},
+                    {
+                        "$set": {"document_hash": content_hash},
+                        "$inc": {"version": 1},
+                    },
+                    upsert=True,
+                )
+                for order_id, content_hash in content_hashes.items()
+            ],
+            ordered=False,
+            session=self.session,
+        )
+
+    async def get_report_document_by_order_id(self, order_id: ObjectId) -> bytes | None:
+        diagnostic_report = await self.db["diagnostic_reports"].find_one(
+            {"order_id": order_id},
+            {"document_hash": True},
+            session=self.session,
+        )
+        if not diagnostic_report or not diagnostic_report.get("document_hash"):
+            return None
+        document = await self.db["report_documents"].find_one(
+            {"_id": diagnostic_report["document_hash"]},
+            session=self.session,
+        )
+        if not document:
+            raise NotImplementedError
+        return document["content"]
+
+    async def get_client_stats(self, client_id: str) -> Mapping[str, int]:
+        document = await self.db["client_stats"].find_one(
+            {"_id": client_id},
+            {"_id": False},
+            session=self.session,
+        )
+        return document or {}
+
+    # Counters are only updated by the sequential event handler, so concurrent
+    # requests of one client do not conflict on its `client_stats` document
+
+    async def count_order(self, client_id: str) -> None:
+        await self._increment_client_stats(client_id, {"orders": 1})
+
+    async def count_sample_collected(self, order_id: ObjectId, client_id: str) -> None:
+        counted = await self._mark_counted(order_id, {"sample": True})
+        if not counted.get("sample"):
+            await self._increment_client_stats(client_id, {"samples_collected": 1})
+
+    async def count_result_checked(
+        self,
+        order_id: ObjectId,
+        client_id: str,
+        result: rapid_testing.RapidTestResult,
+    ) -> None:
+        counted = await self._mark_counted(order_id, {"result": str(result)})
+        increments: Counter[str] = Counter({str(result): 1})
+        if counted.get("result"):
+            increments[counted["result"]] -= 1
+        await self._increment_client_stats(client_id, increments)
+
+    async def rebuild_client_stats(self) -> None:
+        # Counters are rebuilt aside and swapped in at once, but increments
+        # made while rebuilding are lost, so events must not be handled meanwhile
+        await (
+            self.db["orders"]
+            .aggregate(
+                [
+                    {"$group": {"_id": "$client", "orders": {"$sum": 1}}},
+                    {"$out": "client_stats_rebuild"},
+                ],
+                session=self.session,
+            )
+            .to_list(None)
+        )
+        await (
+            self.db["rapid_tests"]
+            .aggregate(
+                [
+                    {
+                        "$group": {
+                            "_id": "$client_id",
+                            "samples_collected": {
+                                "$sum": {
+                                    "$cond": [{"$ifNull": ["$sample_id", False]}, 1, 0]
+                                }
+                            },
+                            **{
+                                str(result): {
+                                    "$sum": {
+                                        "$cond": [
+                                            {"$eq": ["$result", str(result)]},
+                                            1,
+                                            0,
+                                        ]
+                                    }
+                                }
+                                for result in rapid_testing.RapidTestResult
+                            },
+                        }
+                    },
+                    {"$merge": {"into": "client_stats_rebuild"}},
+                ],
+                session=self.session,
+            )
+            .to_list(None)
+        )
+        await (
+            self.db["rapid_tests"]
+            .aggregate(
+                [
+                    {
+                        "$project": {
+                            "_id": "$order_id",
+                            "sample": {"$toBool": {"$ifNull": ["$sample_id", False]}},
+                            "result": {"$ifNull": ["$result", None]},
+                        }
+                    },
+                    {"$out": "counted_rapid_tests"},
+                ],
+                session=self.session,
             )
+            .to_list(None)
         )
+        await self.db["client_stats_rebuild"].rename(
+            "client_stats",
+            dropTarget=True,
+            session=self.session,
+        )
+
+    async def _mark_counted(
+        self, order_id: ObjectId, fields: Mapping[str, Any]
+    ) -> Mapping[str, Any]:
+        # Returns what was counted before, so redelivered events count once
+        previous = await self.db["counted_rapid_tests"].find_one_and_update(
+            {"_id": order_id},
+            {"$set": fields},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+            session=self.session,
+        )
+        return previous or {}
+
+    async def _increment_client_stats(
+        self, client_id: str, increments: Mapping[str, int]
+    ) -> None:
+        increments = {field: value for field, value in increments.items() if value}
+        if increments:
+            await self.db["client_stats"].update_one(
+                {"_id": client_id},
+                {"$inc": increments},
+                upsert=True,
+                session=self.session,
+            )
+
+    async def _remove_duplicate_orders(self, collection: str) -> None:
+        # Databases created before the unique index may hold several documents
+        # of one order, e.g. a report per checked result, so keep the latest one
+        duplicates = (
+            await self.db[collection]
+            .aggregate(
+                [
+                    {"$sort": {"_id": -1}},
+                    {
+                        "$group": {
+                            "_id": "$order_id",
+                            "ids": {"$push": "$_id"},
+                            "count": {"$sum": 1},
+                        }
+                    },
+                    {"$match": {"count": {"$gt": 1}}},
+                ],
+                session=self.session,
+            )
+            .to_list(None)
+        )
+        stale_ids = [id_ for duplicate in duplicates for id_ in duplicate["ids"][1:]]
+        if stale_ids:
+            await self.db[collection].delete_many(
+                {"_id": {"$in": stale_ids}},
+                session=self.session,
+            )
+
+    async def _get_version(
+        self, collection: str, query: Mapping[str, Any]
+    ) -> int | None:
+        document = await self.db[collection].find_one(
+            query,
+            {"version": True},
+            session=self.session,
+        )
+        if not document:
+            return None
+        return document.get("version", 0)
@@ -0,0 +1,87 @@
+import asyncio
+from datetime import timedelta
+
+from bson import ObjectId
+from event_outbox import EventOutbox
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from example.domain import booking
+from example.infrastructure.database import Database
+from example.infrastructure.message_queue import BookingEventListener
+
+_PendingOrder = tuple[booking.Client, "asyncio.Future[booking.Order]"]
+
+
+class OrderBatcher:
+    def __init__(
+        self,
+        mongo_client: AsyncIOMotorClient,
+        outbox: EventOutbox,
+        *,
+        window: timedelta,
+        max_batch_size: int,
+    ) -> None:
+        self.mongo_client = mongo_client
+        self.outbox = outbox
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: list[_PendingOrder] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._commits: set[asyncio.Task[None]] = set()
+
+    async def create_order(self, client: booking.Client) -> booking.Order:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[booking.Order] = loop.create_future()
+        self._pending.append((client, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window.total_seconds(), self._flush)
+        return await future
+
+    async def aclose(self) -> None:
+        self._flush()
+        await asyncio.gather(*self._commits, return_exceptions=True)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._commit(batch))
+        self._commits.add(task)
+        task.add_done_callback(self._commits.discard)
+
+    async def _commit(self, batch: list[_PendingOrder]) -> None:
+        created: list[tuple[asyncio.Future[booking.Order], booking.Order]] = []
+        try:
+            async with await self.mongo_client.start_session() as session:
+                database = Database(self.mongo_client.get_default_database(), session)
+                async with self.outbox.event_listener(session) as listener:
+                    for client, future in batch:
+                        # Callers that gave up waiting do not get an order
+                        if future.done():
+                            continue
+                        try:
+                            order = client.create_order(
+                                str(ObjectId()), BookingEventListener(listener)
+                            )
+                        except Exception as ex:
+                            _set_exception(future, ex)
+                        else:
+                            created.append((future, order))
+                    await database.insert_orders([order for _, order in created])
+        except Exception as ex:
+            for _, future in batch:
+                _set_exception(future, ex)
+        else:
+            for future, order in created:
+                if not future.done():
+                    future.set_result(order)
+
+
+def _set_exception(future: asyncio.Future[booking.Order], ex: Exception) -> None:
+    if not future.done():
+        future.set_exception(ex)
@@ -1,37 +1,41 @@
 import logging.config
+import math
+import secrets
 from contextlib import AsyncExitStack, asynccontextmanager
-from datetime import timedelta
-from pathlib import Path
-from typing import Annotated, AsyncIterator
+from datetime import UTC, datetime, timedelta
+from typing import Annotated, AsyncIterator, Literal
 
-import dynaconf
 from aiokafka import AIOKafkaConsumer, AIOKafkaProducer
 from bson import ObjectId
-from event_outbox import EventOutbox
-from fastapi import APIRouter, Depends, FastAPI
-from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel
+from event_outbox import Event, EventOutbox
+from fastapi import (
+    APIRouter,
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.responses import PlainTextResponse
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorClientSession
+from pydantic import AwareDatetime, BaseModel, Field
 
 from example.domain import booking, reporting
 from example.domain.rapid_testing import Collector, RapidTestResult, Sample
+from example.infrastructure.analytics import PositivitySnapshot, run_snapshot_updates
+from example.infrastructure.config import config
 from example.infrastructure.database import Database
+from example.infrastructure.group_commit import OrderBatcher
 from example.infrastructure.message_queue import (
     BookingEventListener,
     RapidTestingEventListener,
     handle_event,
 )
-
-settings_path = Path(__file__).parent.parent.parent / "settings"
-config = dynaconf.Dynaconf(
-    environments=True,
-    settings_files=[
-        settings_path / "default.toml",
-        settings_path / "test.toml",
-        settings_path / "local.toml",
-    ],
-    load_dotenv=True,
-    merge_enabled=True,
-)
+from example.infrastructure.profiling import SamplingProfiler
+from example.infrastructure.report_rendering import create_render_executor
 
 
 def get_mongo_client() -> AsyncIOMotorClient:
@@ -42,8 +46,25 @@ def get_event_outbox() -> EventOutbox:
     raise NotImplementedError
 
 
+def get_order_batcher() -> OrderBatcher | None:
+    raise NotImplementedError
+
+
+def get_profiler() -> SamplingProfiler:
+    raise NotImplementedError
+
+
+def get_positivity_snapshot() -> PositivitySnapshot:
+    raise NotImplementedError
+
+
 MongoClientDependency = Annotated[AsyncIOMotorClient, Depends(get_mongo_client)]
 EventOutboxDependency = Annotated[EventOutbox, Depends(get_event_outbox)]
+OrderBatcherDependency = Annotated[OrderBatcher | None, Depends(get_order_batcher)]
+ProfilerDependency = Annotated[SamplingProfiler, Depends(get_profiler)]
+PositivitySnapshotDependency = Annotated[
+    PositivitySnapshot, Depends(get_positivity_snapshot)
+]
 
 
 @asynccontextmanager
@@ -54,6 +75,17 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
             tz_aware=True,
         )
         stack.callback(mongo_client.close)
+        profiler = SamplingProfiler(
+            enabled=config.profiling.enabled,
+            sample_rate=config.profiling.sample_rate,
+            interval=timedelta(milliseconds=config.profiling.interval_milliseconds),
+            max_depth=config.profiling.max_depth,
+            max_stacks=config.profiling.max_stacks,
+        )
+        stack.callback(profiler.close)
+        executor = stack.enter_context(
+            create_render_executor(config.reporting.render_workers or None)
+        )
         kafka_producer = await stack.enter_async_context(
             # TODO: Configure broker:
             #   min.insync.replicas = len(replicas) - 1
@@ -80,20 +112,50 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
                 seconds=config.mongo.event_expiration_seconds
             ),
         )
+        positivity_snapshot = PositivitySnapshot()
+        analytics_consumer = await stack.enter_async_context(
+            AIOKafkaConsumer(
+                "rapid_testing",
+                bootstrap_servers=config.kafka.bootstrap_servers,
+                enable_auto_commit=False,
+                auto_offset_reset="earliest",
+            )
+        )
+        await stack.enter_async_context(
+            run_snapshot_updates(positivity_snapshot, analytics_consumer)
+        )
         await event_outbox.create_indexes()
+        async with await mongo_client.start_session() as session:
+            await Database(
+                mongo_client.get_default_database(), session
+            ).create_indexes()
+
+        async def handle_profiled_event(
+            event: Event, session: AsyncIOMotorClientSession
+        ) -> None:
+            with profiler.profile(f"{event.topic}/{event.content_schema}"):
+                await handle_event(event, session, mongo_client, event_outbox, executor)
+
         await stack.enter_async_context(
-            event_outbox.run_event_handler(
-                lambda event, session: handle_event(
-                    event,
-                    session,
-                    mongo_client,
-                    event_outbox,
-                )
-            )
+            event_outbox.run_event_handler(handle_profiled_event)
         )
+        order_batcher = None
+        if config.booking.group_commit.enabled:
+            order_batcher = OrderBatcher(
+                mongo_client,
+                event_outbox,
+                window=timedelta(
+                    milliseconds=config.booking.group_commit.window_milliseconds
+                ),
+                max_batch_size=config.booking.group_commit.max_batch_size,
+            )
+            stack.push_async_callback(order_batcher.aclose)
         app.dependency_overrides = {
             get_mongo_client: lambda: mongo_client,
             get_event_outbox: lambda: event_outbox,
+            get_order_batcher: lambda: order_batcher,
+            get_profiler: lambda: profiler,
+            get_positivity_snapshot: lambda: positivity_snapshot,
         }
         logging.config.dictConfig(config.logging.to_dict())
         yield
@@ -102,6 +164,7 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
 def create_app() -> FastAPI:
     app = FastAPI(lifespan=lifespan)
     app.include_router(router)
+    app.include_router(admin_router)
     return app
 
 
@@ -118,19 +181,68 @@ class OrderResource(BaseModel):
     client_id: str
 
 
+class ClientStatsResource(BaseModel):
+    orders: int = 0
+    samples_collected: int = 0
+    positive: int = 0
+    negative: int = 0
+    invalid: int = 0
+
+
+class PositivityBucketResource(BaseModel):
+    start: datetime
+    positive: int
+    negative: int
+    invalid: int
+    rate: float | None
+
+
+class PositivityResource(BaseModel):
+    bucket: Literal["hour", "day"]
+    window: int
+    # False while results published before startup are still being read
+    complete: bool
+    buckets: list[PositivityBucketResource]
+
+
 class EmptyResponse(BaseModel):
     pass
 
 
-router = APIRouter()
+class ProfilingSettings(BaseModel):
+    enabled: bool
+    sample_rate: float = Field(ge=0, le=1)
+
+
+class HotFrameResource(BaseModel):
+    frame: str
+    samples: int
+    ratio: float
+
+
+async def profile_request(
+    request: Request, profiler: ProfilerDependency
+) -> AsyncIterator[None]:
+    with profiler.profile(f"{request.method} {request.scope['route'].path}"):
+        yield
+
+
+router = APIRouter(dependencies=[Depends(profile_request)])
 
 
 @router.post("/client/{client_id}/orders")
 async def create_order(
-    client_id: str, mongo_client: MongoClientDependency, outbox: EventOutboxDependency
+    client_id: str,
+    mongo_client: MongoClientDependency,
+    outbox: EventOutboxDependency,
+    order_batcher: OrderBatcherDependency,
 ) -> OrderResource:
     client = booking.Client(client_id)
 
+    if order_batcher is not None:
+        order = await order_batcher.create_order(client)
+        return OrderResource(id=order.id, client_id=order.client.id)
+
     async with await mongo_client.start_session() as session:
         database = Database(mongo_client.get_default_database(), session)
         async with outbox.event_listener(session) as listener:
@@ -140,30 +252,71 @@ async def create_order(
     return OrderResource(id=order.id, client_id=order.client.id)
 
 
-@router.get("/client/{client_id}/orders/{order_id}/report")
+@router.get("/client/{client_id}/stats")
+async def get_client_stats(
+    client_id: str, mongo_client: MongoClientDependency
+) -> ClientStatsResource:
+    async with await mongo_client.start_session() as session:
+        database = Database(mongo_client.get_default_database(), session)
+        client_stats = await database.get_client_stats(client_id)
+
+    return ClientStatsResource.model_validate(client_stats)
+
+
+@router.get(
+    "/client/{client_id}/orders/{order_id}/report",
+    response_class=Response,
+)
 async def get_report(
-    order_id: str, client_id: str, mongo_client: MongoClientDependency
-) -> EmptyResponse:
+    order_id: str,
+    client_id: str,
+    mongo_client: MongoClientDependency,
+    range_header: Annotated[str | None, Header(alias="Range")] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
     client = reporting.Client(client_id)
 
     async with await mongo_client.start_session() as session:
         database = Database(mongo_client.get_default_database(), session)
+        version = await database.get_diagnostic_report_version(
+            ObjectId(order_id), client_id
+        )
+        headers = _validator_headers(version)
+        if _not_modified(headers, if_none_match):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
         diagnostic_report = await database.get_diagnostic_report_by_order_id(
             ObjectId(order_id)
         )
         client.read_diagnostic_report(diagnostic_report)
+        content = await database.get_report_document_by_order_id(ObjectId(order_id))
 
-    return EmptyResponse()
+    if content is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            "Diagnostic report document is not rendered yet",
+        )
+
+    return _byte_range_response(
+        content, range_header, media_type="text/html", headers=headers
+    )
 
 
-@router.get("/orders/{order_id}")
+@router.get("/orders/{order_id}", response_model=OrderResource)
 async def get_order(
-    order_id: str, mongo_client: MongoClientDependency
-) -> OrderResource:
+    order_id: str,
+    response: Response,
+    mongo_client: MongoClientDependency,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> OrderResource | Response:
     async with await mongo_client.start_session() as session:
         database = Database(mongo_client.get_default_database(), session)
+        version = await database.get_order_version(ObjectId(order_id))
+        headers = _validator_headers(version)
+        if _not_modified(headers, if_none_match):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
         order = await database.get_order(ObjectId(order_id))
 
+    response.headers.update(headers)
     return OrderResource(
         id=order_id,
         client_id=order.client.id,
@@ -214,3 +367,177 @@ async def check_result(
             await database.update_rapid_test(rapid_test)
 
     return EmptyResponse()
+
+
+@router.get("/analytics/positivity")
+async def get_positivity(
+    snapshot: PositivitySnapshotDependency,
+    bucket: Literal["hour", "day"] = "day",
+    window: Annotated[int, Query(ge=1)] = 1,
+    start: AwareDatetime | None = None,
+    end: AwareDatetime | None = None,
+) -> PositivityResource:
+    bucket_size = timedelta(hours=1) if bucket == "hour" else timedelta(days=1)
+    end = _align_to_bucket(end or datetime.now(tz=UTC), bucket_size, round_up=True)
+    start = _align_to_bucket(start or end - 30 * bucket_size, bucket_size)
+    # The window extends the counted buckets backwards
+    bucket_count = (end - start) / bucket_size + window - 1
+    if not start < end or bucket_count > config.analytics.max_buckets:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"Expected up to {config.analytics.max_buckets} buckets "
+            f"between start and end, including the window",
+        )
+
+    buckets = snapshot.buckets(start, end, bucket_size, window)
+
+    return PositivityResource(
+        bucket=bucket,
+        window=window,
+        complete=snapshot.caught_up,
+        buckets=[
+            PositivityBucketResource(
+                start=datetime.fromtimestamp(bucket_start, tz=UTC),
+                positive=positive,
+                negative=negative,
+                invalid=invalid,
+                rate=None if math.isnan(rate) else rate,
+            )
+            for bucket_start, positive, negative, invalid, rate in zip(
+                buckets.starts.tolist(),
+                buckets.positive.tolist(),
+                buckets.negative.tolist(),
+                buckets.invalid.tolist(),
+                buckets.rate.tolist(),
+            )
+        ],
+    )
+
+
+def require_admin_token(
+    authorization: Annotated[str | None, Header()] = None,
+) -> None:
+    # An empty token disables the admin API
+    token = config.admin.token
+    if not token:
+        raise HTTPException(status.HTTP_403_FORBIDDEN, "Admin API is disabled")
+    scheme, _, credentials = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(
+        credentials.encode(), token.encode()
+    ):
+        raise HTTPException(
+            status.HTTP_401_UNAUTHORIZED,
+            "Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+admin_router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin_token)])
+
+
+@admin_router.get("/profiling")
+async def get_profiling_settings(profiler: ProfilerDependency) -> ProfilingSettings:
+    return ProfilingSettings(
+        enabled=profiler.enabled,
+        sample_rate=profiler.sample_rate,
+    )
+
+
+@admin_router.put("/profiling")
+async def update_profiling_settings(
+    request: ProfilingSettings, profiler: ProfilerDependency
+) -> ProfilingSettings:
+    profiler.enabled = request.enabled
+    profiler.sample_rate = request.sample_rate
+    return request
+
+
+@admin_router.get("/profiling/flamegraph", response_class=PlainTextResponse)
+async def get_flamegraph(profiler: ProfilerDependency) -> str:
+    return profiler.folded_stacks()
+
+
+@admin_router.get("/profiling/hot-frames")
+async def get_hot_frames(
+    profiler: ProfilerDependency, limit: int = 20
+) -> list[HotFrameResource]:
+    return [
+        HotFrameResource(frame=frame, samples=samples, ratio=ratio)
+        for frame, samples, ratio in profiler.hot_frames(limit)
+    ]
+
+
+@admin_router.delete("/profiling/samples")
+async def reset_profiling_samples(profiler: ProfilerDependency) -> EmptyResponse:
+    profiler.reset()
+    return EmptyResponse()
+
+
+def _align_to_bucket(
+    moment: datetime, bucket_size: timedelta, *, round_up: bool = False
+) -> datetime:
+    # Buckets since the epoch start at UTC hours and midnights
+    offset = (moment - datetime.fromtimestamp(0, tz=UTC)) % bucket_size
+    if not offset:
+        return moment
+    return moment - offset + (bucket_size if round_up else timedelta())
+
+
+def _validator_headers(version: int | None) -> dict[str, str]:
+    # Versions are bumped by `Database` on every write of the document
+    if version is None:
+        return {}
+    return {"ETag": f'"{version}"', "Cache-Control": "private, no-cache"}
+
+
+def _not_modified(headers: dict[str, str], if_none_match: str | None) -> bool:
+    if "ETag" not in headers or not if_none_match:
+        return False
+    return any(
+        etag.strip().removeprefix("W/") in ("*", headers["ETag"])
+        for etag in if_none_match.split(",")
+    )
+
+
+def _byte_range_response(
+    content: bytes,
+    range_header: str | None,
+    media_type: str,
+    headers: dict[str, str],
+) -> Response:
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    byte_range = _parse_byte_range(range_header, len(content)) if range_header else None
+    if byte_range is None:
+        return Response(content, media_type=media_type, headers=headers)
+
+    first, last = byte_range
+    headers["Content-Range"] = f"bytes {first}-{last}/{len(content)}"
+    return Response(
+        content[first : last + 1],
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+def _parse_byte_range(range_header: str, size: int) -> tuple[int, int] | None:
+    # Only a single range is supported, anything else is served in full
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in byte_range:
+        return None
+    first, _, last = byte_range.strip().partition("-")
+    try:
+        if first:
+            first_position = int(first)
+            last_position = min(int(last), size - 1) if last else size - 1
+        else:
+            first_position = max(size - int(last), 0)
+            last_position = size - 1
+    except ValueError:
+        return None
+    if first_position > last_position:
+        raise HTTPException(
+            status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return first_position, last_position
@@ -1,15 +1,19 @@
+import asyncio
 import logging
-from typing import Literal
+from concurrent.futures import Executor
+from typing import Awaitable, Iterable, Literal, Protocol
 
 from bson import ObjectId
 from event_outbox import Event, EventListener, EventOutbox
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorClientSession
+from pydantic import ValidationError
 
 from example.domain import booking, rapid_testing, reporting
 from example.domain.booking import Order
-from example.domain.rapid_testing import RapidTest, RapidTestResult, Sample
+from example.domain.rapid_testing import Collector, RapidTest, RapidTestResult, Sample
 from example.domain.reporting import DiagnosticReport
 from example.infrastructure.database import Database
+from example.infrastructure.report_rendering import render_diagnostic_report
 
 
 class OrderCreated(Event):
@@ -24,6 +28,8 @@ class ResultChecked(Event):
     content_schema: Literal["ResultChecked"] = "ResultChecked"
     order_id: str
     client_id: str
+    # Missing in events published before results were carried by the event
+    result: RapidTestResult | None = None
 
 
 class RapidTestScheduled(Event):
@@ -34,11 +40,19 @@ class RapidTestScheduled(Event):
 class DiagnosticReportGenerated(Event):
     topic: Literal["reporting"] = "reporting"
     content_schema: Literal["DiagnosticReportGenerated"] = "DiagnosticReportGenerated"
+    # Missing in events published before reports were rendered
+    order_id: str | None = None
+    client_id: str | None = None
+    result: str | None = None
 
 
 class SampleCollected(Event):
     topic: Literal["rapid_testing"] = "rapid_testing"
     content_schema: Literal["SampleCollected"] = "SampleCollected"
+    # Missing in events published before samples were carried by the event
+    order_id: str | None = None
+    client_id: str | None = None
+    sample_id: str | None = None
 
 
 class BookingEventListener(booking.EventListener):
@@ -59,13 +73,20 @@ class RapidTestingEventListener(rapid_testing.EventListener):
         self.listener.event_occurred(RapidTestScheduled())
 
     def sample_collected(self, rapid_test: RapidTest, sample: Sample) -> None:
-        self.listener.event_occurred(SampleCollected())
+        self.listener.event_occurred(
+            SampleCollected(
+                order_id=rapid_test.order.id,
+                client_id=rapid_test.order.client_id,
+                sample_id=sample.id,
+            )
+        )
 
     def result_checked(self, rapid_test: RapidTest, result: RapidTestResult) -> None:
         self.listener.event_occurred(
             ResultChecked(
                 order_id=rapid_test.order.id,
                 client_id=rapid_test.order.client_id,
+                result=result,
             )
         )
 
@@ -75,7 +96,78 @@ class ReportingEventListener(reporting.EventListener):
         self.listener = listener
 
     def diagnostic_report_generated(self, diagnostic_report: DiagnosticReport) -> None:
-        self.listener.event_occurred(DiagnosticReportGenerated())
+        self.listener.event_occurred(
+            DiagnosticReportGenerated(
+                order_id=diagnostic_report.order_id,
+                client_id=diagnostic_report.client.id,
+                result=diagnostic_report.result,
+            )
+        )
+
+
+class ProjectionWriter(Protocol):
+    async def insert_rapid_test(self, rapid_test: RapidTest) -> None:
+        pass  # pragma: no cover
+
+    async def insert_diagnostic_report(
+        self, diagnostic_report: DiagnosticReport
+    ) -> None:
+        pass  # pragma: no cover
+
+    async def insert_report_document(self, order_id: ObjectId, content: bytes) -> None:
+        pass  # pragma: no cover
+
+
+async def schedule_rapid_test(
+    order_created: OrderCreated,
+    listener: rapid_testing.EventListener,
+    writer: ProjectionWriter,
+) -> None:
+    rapid_test = RapidTest.schedule(
+        rapid_testing.Order(
+            order_id=order_created.order_id,
+            client_id=order_created.client_id,
+        ),
+        listener,
+    )
+    await writer.insert_rapid_test(rapid_test)
+
+
+async def generate_diagnostic_report(
+    result_checked: ResultChecked,
+    result: RapidTestResult,
+    listener: reporting.EventListener,
+    writer: ProjectionWriter,
+) -> None:
+    diagnostic_report = DiagnosticReport.generate(
+        reporting.Client(client_id=result_checked.client_id),
+        result_checked.order_id,
+        str(result),
+        listener,
+    )
+    await writer.insert_diagnostic_report(diagnostic_report)
+
+
+async def store_report_document(
+    report_generated: DiagnosticReportGenerated,
+    writer: ProjectionWriter,
+    executor: Executor,
+) -> None:
+    order_id = report_generated.order_id
+    client_id = report_generated.client_id
+    result = report_generated.result
+    if order_id is None or client_id is None or result is None:
+        _skip_legacy_event(report_generated)
+        return
+    content = await asyncio.get_running_loop().run_in_executor(
+        executor,
+        render_diagnostic_report,
+        order_id,
+        client_id,
+        result,
+        report_generated.occurred_at,
+    )
+    await writer.insert_report_document(ObjectId(order_id), content)
 
 
 async def handle_event(
@@ -83,31 +175,202 @@ async def handle_event(
     session: AsyncIOMotorClientSession,
     mongo_client: AsyncIOMotorClient,
     outbox: EventOutbox,
+    executor: Executor,
 ) -> None:
     if (event.topic, event.content_schema) == ("booking", "OrderCreated"):
         order_created = OrderCreated.model_validate(event, from_attributes=True)
         database = Database(mongo_client.get_default_database(), session)
         async with outbox.event_listener(session) as listener:
-            rapid_test = RapidTest.schedule(
-                rapid_testing.Order(
-                    order_id=order_created.order_id,
-                    client_id=order_created.client_id,
-                ),
+            await schedule_rapid_test(
+                order_created,
                 RapidTestingEventListener(listener),
+                database,
+            )
+        await database.count_order(order_created.client_id)
+
+    if (event.topic, event.content_schema) == ("rapid_testing", "SampleCollected"):
+        sample_collected = SampleCollected.model_validate(event, from_attributes=True)
+        database = Database(mongo_client.get_default_database(), session)
+        if sample_collected.order_id is None or sample_collected.client_id is None:
+            _skip_legacy_event(event)
+        else:
+            await database.count_sample_collected(
+                ObjectId(sample_collected.order_id), sample_collected.client_id
             )
-            await database.insert_rapid_test(rapid_test)
 
     if (event.topic, event.content_schema) == ("rapid_testing", "ResultChecked"):
         result_checked = ResultChecked.model_validate(event, from_attributes=True)
         database = Database(mongo_client.get_default_database(), session)
-        async with outbox.event_listener(session) as listener:
-            diagnostic_report = DiagnosticReport.generate(
-                reporting.Client(client_id=result_checked.client_id),
-                ReportingEventListener(listener),
+        result = result_checked.result
+        if result is None:
+            rapid_test = await database.get_rapid_test_by_order_id(
+                ObjectId(result_checked.order_id)
             )
-            await database.insert_diagnostic_report(
-                diagnostic_report,
-                ObjectId(result_checked.order_id),
+            result = rapid_test.result
+        if result is None:
+            _skip_legacy_event(event)
+        else:
+            async with outbox.event_listener(session) as listener:
+                await generate_diagnostic_report(
+                    result_checked,
+                    result,
+                    ReportingEventListener(listener),
+                    database,
+                )
+            await database.count_result_checked(
+                ObjectId(result_checked.order_id), result_checked.client_id, result
             )
 
+    if (event.topic, event.content_schema) == (
+        "reporting",
+        "DiagnosticReportGenerated",
+    ):
+        report_generated = DiagnosticReportGenerated.model_validate(
+            event, from_attributes=True
+        )
+        database = Database(mongo_client.get_default_database(), session)
+        await store_report_document(report_generated, database, executor)
+
     logging.getLogger(__name__).debug("Event handled: %s", event)
+
+
+class ReplayEventListener(
+    booking.EventListener,
+    rapid_testing.EventListener,
+    reporting.EventListener,
+):
+    def order_created(self, order: Order) -> None:
+        pass
+
+    def rapid_test_scheduled(self, rapid_test: RapidTest) -> None:
+        pass
+
+    def sample_collected(self, rapid_test: RapidTest, sample: Sample) -> None:
+        pass
+
+    def result_checked(self, rapid_test: RapidTest, result: RapidTestResult) -> None:
+        pass
+
+    def diagnostic_report_generated(self, diagnostic_report: DiagnosticReport) -> None:
+        pass
+
+
+class ReplayWriter:
+    def __init__(self) -> None:
+        self.rapid_tests: dict[str, RapidTest] = {}
+        self.diagnostic_reports: dict[str, DiagnosticReport] = {}
+        self.report_documents: dict[ObjectId, bytes] = {}
+
+    def rapid_test(self, order_id: str, client_id: str) -> RapidTest:
+        return self.rapid_tests.setdefault(
+            order_id,
+            RapidTest(rapid_testing.Order(order_id=order_id, client_id=client_id)),
+        )
+
+    async def insert_rapid_test(self, rapid_test: RapidTest) -> None:
+        # Keep a sample or result restored earlier in the same batch
+        self.rapid_tests.setdefault(rapid_test.order.id, rapid_test)
+
+    async def insert_diagnostic_report(
+        self, diagnostic_report: DiagnosticReport
+    ) -> None:
+        self.diagnostic_reports[diagnostic_report.order_id] = diagnostic_report
+
+    async def insert_report_document(self, order_id: ObjectId, content: bytes) -> None:
+        self.report_documents[order_id] = content
+
+    async def flush(self, database: Database) -> None:
+        await database.upsert_rapid_tests(self.rapid_tests.values())
+        await database.upsert_diagnostic_reports(self.diagnostic_reports.values())
+        await database.upsert_report_documents(self.report_documents)
+
+
+async def replay_events(
+    events: Iterable[Event], database: Database, executor: Executor
+) -> None:
+    # Same handlers as `handle_event`, but follow-up events are discarded and
+    # the resulting state is written with bulk upserts. Sample and result
+    # updates, which are written by HTTP requests outside of replay,
+    # are restored from their events.
+    listener = ReplayEventListener()
+    writer = ReplayWriter()
+    renders: list[Awaitable[None]] = []
+
+    for event in events:
+        try:
+            if (event.topic, event.content_schema) == ("booking", "OrderCreated"):
+                order_created = OrderCreated.model_validate(event, from_attributes=True)
+                await schedule_rapid_test(order_created, listener, writer)
+
+            if (event.topic, event.content_schema) == (
+                "rapid_testing",
+                "SampleCollected",
+            ):
+                sample_collected = SampleCollected.model_validate(
+                    event, from_attributes=True
+                )
+                if (
+                    sample_collected.order_id is None
+                    or sample_collected.client_id is None
+                    or sample_collected.sample_id is None
+                ):
+                    _skip_legacy_event(event)
+                else:
+                    Collector().collect_sample(
+                        writer.rapid_test(
+                            sample_collected.order_id,
+                            sample_collected.client_id,
+                        ),
+                        Sample(sample_id=sample_collected.sample_id),
+                        listener,
+                    )
+
+            if (event.topic, event.content_schema) == (
+                "rapid_testing",
+                "ResultChecked",
+            ):
+                result_checked = ResultChecked.model_validate(
+                    event, from_attributes=True
+                )
+                if result_checked.result is None:
+                    _skip_legacy_event(event)
+                else:
+                    Collector().check_result(
+                        writer.rapid_test(
+                            result_checked.order_id,
+                            result_checked.client_id,
+                        ),
+                        result_checked.result,
+                        listener,
+                    )
+                    await generate_diagnostic_report(
+                        result_checked,
+                        result_checked.result,
+                        listener,
+                        writer,
+                    )
+
+            if (event.topic, event.content_schema) == (
+                "reporting",
+                "DiagnosticReportGenerated",
+            ):
+                report_generated = DiagnosticReportGenerated.model_validate(
+                    event, from_attributes=True
+                )
+                # Rendering is CPU-bound, so documents are rendered concurrently
+                renders.append(
+                    store_report_document(report_generated, writer, executor)
+                )
+        except ValidationError:
+            logging.getLogger(__name__).warning(
+                "Skipped malformed event: %s", event, exc_info=True
+            )
+
+    await asyncio.gather(*renders)
+    await writer.flush(database)
+
+
+def _skip_legacy_event(event: Event) -> None:
+    logging.getLogger(__name__).warning(
+        "Skipped event published before its fields were added: %s", event
+    )
@@ -0,0 +1,111 @@
+import asyncio
+import random
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+from types import FrameType
+from typing import Any, Iterator
+
+_Stack = tuple[str, ...]
+
+
+class SamplingProfiler:
+    def __init__(
+        self,
+        *,
+        enabled: bool,
+        sample_rate: float,
+        interval: timedelta,
+        max_depth: int,
+        max_stacks: int,
+    ) -> None:
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self.stacks: Counter[_Stack] = Counter()
+        self._labels: dict[asyncio.Task[Any], str] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler: threading.Thread | None = None
+
+    @contextmanager
+    def profile(self, label: str) -> Iterator[None]:
+        task = asyncio.current_task()
+        if not self.enabled or not task or random.random() >= self.sample_rate:
+            yield
+            return
+
+        self._ensure_sampler_started()
+        self._labels[task] = label
+        try:
+            yield
+        finally:
+            self._labels.pop(task, None)
+
+    def folded_stacks(self) -> str:
+        with self._lock:
+            stacks = self.stacks.copy()
+        return "".join(
+            f"{';'.join(stack)} {samples}\n" for stack, samples in stacks.items()
+        )
+
+    def hot_frames(self, limit: int) -> list[tuple[str, int, float]]:
+        with self._lock:
+            stacks = self.stacks.copy()
+        total = stacks.total()
+        self_samples: Counter[str] = Counter()
+        for stack, samples in stacks.items():
+            self_samples[stack[-1]] += samples
+        return [
+            (frame, samples, samples / total)
+            for frame, samples in self_samples.most_common(limit)
+        ]
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stacks.clear()
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._sampler:
+            self._sampler.join()
+
+    def _ensure_sampler_started(self) -> None:
+        if self._sampler:
+            return
+        self._sampler = threading.Thread(
+            target=self._sample,
+            args=(asyncio.get_running_loop(), threading.get_ident()),
+            name="sampling-profiler",
+            daemon=True,
+        )
+        self._sampler.start()
+
+    def _sample(self, loop: asyncio.AbstractEventLoop, thread_id: int) -> None:
+        # Runs in a separate thread and only reads the event loop thread state,
+        # so unsampled requests and handlers pay nothing
+        while not self._stopped.wait(self.interval.total_seconds()):
+            if not self._labels:
+                continue
+            label = self._labels.get(asyncio.current_task(loop))  # type: ignore[arg-type]
+            frame = sys._current_frames().get(thread_id)
+            if label is None or frame is None:
+                continue
+            stack = (label, *self._frame_names(frame))
+            with self._lock:
+                if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                    self.stacks[stack] += 1
+
+    def _frame_names(self, frame: FrameType | None) -> list[str]:
+        names: list[str] = []
+        while frame and len(names) < self.max_depth:
+            names.append(
+                f"{frame.f_globals.get('__name__')}:{frame.f_code.co_qualname}"
+            )
+            frame = frame.f_back
+        names.reverse()
+        return names
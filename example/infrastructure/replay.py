@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import logging.config
+import time
+from concurrent.futures import Executor
+from contextlib import AsyncExitStack
+from datetime import datetime
+
+from aiokafka import AIOKafkaConsumer, TopicPartition
+from event_outbox import Event
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from example.infrastructure.config import config
+from example.infrastructure.database import Database
+from example.infrastructure.message_queue import replay_events
+from example.infrastructure.report_rendering import create_render_executor
+
+TOPICS = ("booking", "rapid_testing", "reporting")
+
+
+class ReplayProgress:
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.replayed = 0
+        self.started_at = time.monotonic()
+
+    def advance(self, count: int) -> None:
+        self.replayed += count
+
+    def report(self) -> None:
+        elapsed = time.monotonic() - self.started_at
+        logging.getLogger(__name__).info(
+            "Replayed %d/%d events (%.1f%%, %.0f events/s)",
+            self.replayed,
+            self.total,
+            100 * self.replayed / self.total if self.total else 100,
+            self.replayed / elapsed if elapsed else 0,
+        )
+
+
+async def replay(
+    topics: tuple[str, ...] = TOPICS,
+    *,
+    from_offset: int | None = None,
+    from_timestamp: datetime | None = None,
+    batch_size: int | None = None,
+) -> None:
+    async with AsyncExitStack() as stack:
+        mongo_client: AsyncIOMotorClient = AsyncIOMotorClient(
+            config.mongo.connection_string,
+            tz_aware=True,
+        )
+        stack.callback(mongo_client.close)
+        executor = stack.enter_context(
+            create_render_executor(config.reporting.render_workers or None)
+        )
+        async with await mongo_client.start_session() as session:
+            await Database(
+                mongo_client.get_default_database(), session
+            ).create_indexes()
+
+        kafka_consumer = await stack.enter_async_context(
+            AIOKafkaConsumer(
+                bootstrap_servers=config.kafka.bootstrap_servers,
+                enable_auto_commit=False,
+            )
+        )
+        offsets = await _partition_offsets(
+            kafka_consumer, topics, from_offset, from_timestamp
+        )
+        progress = ReplayProgress(
+            total=sum(end - start for start, end in offsets.values())
+        )
+        reporter = asyncio.create_task(_report_progress(progress))
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                for partition, (start, end) in offsets.items():
+                    if start < end:
+                        task_group.create_task(
+                            _replay_partition(
+                                mongo_client,
+                                executor,
+                                partition,
+                                start,
+                                end,
+                                batch_size or config.replay.batch_size,
+                                progress,
+                            )
+                        )
+        finally:
+            reporter.cancel()
+        progress.report()
+
+        async with await mongo_client.start_session() as session:
+            await Database(
+                mongo_client.get_default_database(), session
+            ).rebuild_client_stats()
+
+
+async def _partition_offsets(
+    kafka_consumer: AIOKafkaConsumer,
+    topics: tuple[str, ...],
+    from_offset: int | None,
+    from_timestamp: datetime | None,
+) -> dict[TopicPartition, tuple[int, int]]:
+    await kafka_consumer.topics()
+    partitions = [
+        TopicPartition(topic, partition)
+        for topic in topics
+        for partition in sorted(kafka_consumer.partitions_for_topic(topic) or ())
+    ]
+    beginning_offsets = await kafka_consumer.beginning_offsets(partitions)
+    end_offsets = await kafka_consumer.end_offsets(partitions)
+
+    start_offsets = dict(beginning_offsets)
+    if from_offset is not None:
+        start_offsets = {
+            partition: max(offset, from_offset)
+            for partition, offset in beginning_offsets.items()
+        }
+    if from_timestamp is not None:
+        timestamp_ms = int(from_timestamp.timestamp() * 1000)
+        offsets_for_times = await kafka_consumer.offsets_for_times(
+            {partition: timestamp_ms for partition in partitions}
+        )
+        start_offsets = {
+            partition: (
+                max(start_offsets[partition], offset_and_timestamp.offset)
+                if offset_and_timestamp
+                else end_offsets[partition]
+            )
+            for partition, offset_and_timestamp in offsets_for_times.items()
+        }
+
+    return {
+        partition: (min(start_offsets[partition], end), end)
+        for partition, end in end_offsets.items()
+    }
+
+
+async def _replay_partition(
+    mongo_client: AsyncIOMotorClient,
+    executor: Executor,
+    partition: TopicPartition,
+    start: int,
+    end: int,
+    batch_size: int,
+    progress: ReplayProgress,
+) -> None:
+    async with AIOKafkaConsumer(
+        bootstrap_servers=config.kafka.bootstrap_servers,
+        enable_auto_commit=False,
+    ) as kafka_consumer:
+        kafka_consumer.assign([partition])
+        kafka_consumer.seek(partition, start)
+        async with await mongo_client.start_session() as session:
+            database = Database(mongo_client.get_default_database(), session)
+            while await kafka_consumer.position(partition) < end:
+                batch = await kafka_consumer.getmany(
+                    partition,
+                    timeout_ms=1000,
+                    max_records=batch_size,
+                )
+                records = [
+                    record for record in batch.get(partition, []) if record.offset < end
+                ]
+                await replay_events(
+                    (Event.model_validate_json(record.value) for record in records),
+                    database,
+                    executor,
+                )
+                progress.advance(len(records))
+
+
+async def _report_progress(progress: ReplayProgress) -> None:
+    while True:
+        await asyncio.sleep(config.replay.progress_interval_seconds)
+        progress.report()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Rebuild read collections from event topics"
+    )
+    parser.add_argument(
+        "--topic",
+        dest="topics",
+        action="append",
+        choices=TOPICS,
+        help="topic to replay, may be repeated (default: all topics)",
+    )
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument(
+        "--from-offset",
+        type=int,
+        help="replay every partition starting at this offset",
+    )
+    start.add_argument(
+        "--from-timestamp",
+        type=datetime.fromisoformat,
+        help="replay events published at or after this ISO 8601 timestamp",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="maximum number of events written per bulk upsert",
+    )
+    args = parser.parse_args()
+
+    logging.config.dictConfig(config.logging.to_dict())
+    asyncio.run(
+        replay(
+            tuple(args.topics or TOPICS),
+            from_offset=args.from_offset,
+            from_timestamp=args.from_timestamp,
+            batch_size=args.batch_size,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
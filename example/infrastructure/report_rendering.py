@@ -0,0 +1,42 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from html import escape
+
+TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Diagnostic report {order_id}</title>
+</head>
+<body>
+<h1>Diagnostic report</h1>
+<dl>
+<dt>Order</dt><dd>{order_id}</dd>
+<dt>Client</dt><dd>{client_id}</dd>
+<dt>Rapid test result</dt><dd>{result}</dd>
+<dt>Generated at</dt><dd>{generated_at}</dd>
+</dl>
+</body>
+</html>
+"""
+
+
+# Runs in a worker process, so it must stay a picklable module-level function
+def render_diagnostic_report(
+    order_id: str, client_id: str, result: str, generated_at: datetime
+) -> bytes:
+    return TEMPLATE.format(
+        order_id=escape(order_id),
+        client_id=escape(client_id),
+        result=escape(result),
+        generated_at=escape(generated_at.isoformat()),
+    ).encode()
+
+
+def create_render_executor(max_workers: int | None) -> ProcessPoolExecutor:
+    # Forking a process that already runs driver threads can deadlock
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
@@ -21,14 +21,27 @@ def client() -> Client:
 
 
 @pytest.fixture
-def diagnostic_report(client: Client, listener: Mock) -> DiagnosticReport:
-    return DiagnosticReport.generate(client, listener)
+def order_id() -> str:
+    return "order-1"
 
 
-def test_generate_diagnostic_report(client: Client, listener: Mock) -> None:
-    diagnostic_report = DiagnosticReport.generate(client, listener)
+@pytest.fixture
+def diagnostic_report(
+    client: Client, order_id: str, listener: Mock
+) -> DiagnosticReport:
+    return DiagnosticReport.generate(client, order_id, "positive", listener)
+
+
+def test_generate_diagnostic_report(
+    client: Client, order_id: str, listener: Mock
+) -> None:
+    diagnostic_report = DiagnosticReport.generate(
+        client, order_id, "positive", listener
+    )
 
     assert diagnostic_report.client is client
+    assert diagnostic_report.order_id is order_id
+    assert diagnostic_report.result == "positive"
 
     listener.assert_has_calls(
         [
@@ -0,0 +1,104 @@
+import math
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from example.domain.rapid_testing import RapidTestResult
+from example.infrastructure.analytics import PositivitySnapshot
+
+
+@pytest.fixture
+def start() -> datetime:
+    return datetime(2024, 6, 1, tzinfo=UTC)
+
+
+@pytest.fixture
+def snapshot(start: datetime) -> PositivitySnapshot:
+    snapshot = PositivitySnapshot(capacity=2)
+    for order, (hour, result) in enumerate(
+        [
+            (0, RapidTestResult.POSITIVE),
+            (0, RapidTestResult.NEGATIVE),
+            (0, RapidTestResult.INVALID),
+            (1, RapidTestResult.NEGATIVE),
+            (2, RapidTestResult.POSITIVE),
+            (2, RapidTestResult.POSITIVE),
+            (5, RapidTestResult.NEGATIVE),
+        ]
+    ):
+        snapshot.add(
+            f"order-{order}",
+            start + timedelta(hours=hour, minutes=30),
+            result,
+        )
+    return snapshot
+
+
+def test_add_grows_snapshot(snapshot: PositivitySnapshot) -> None:
+    assert len(snapshot) == 7
+
+
+def test_redelivered_result_is_added_once(
+    snapshot: PositivitySnapshot, start: datetime
+) -> None:
+    snapshot.add("order-7", start, RapidTestResult.INVALID)
+    snapshot.add("order-7", start + timedelta(minutes=1), RapidTestResult.POSITIVE)
+    snapshot.add("order-7", start + timedelta(minutes=1), RapidTestResult.POSITIVE)
+    snapshot.add("order-7", start, RapidTestResult.INVALID)
+
+    buckets = snapshot.buckets(start, start + timedelta(hours=1), timedelta(hours=1))
+
+    assert len(snapshot) == 8
+    assert buckets.positive.tolist() == [2]
+    assert buckets.invalid.tolist() == [1]
+
+
+def test_later_result_replaces_earlier(
+    snapshot: PositivitySnapshot, start: datetime
+) -> None:
+    snapshot.add(
+        "order-2",
+        start + timedelta(hours=1, minutes=45),
+        RapidTestResult.POSITIVE,
+    )
+
+    buckets = snapshot.buckets(start, start + timedelta(hours=2), timedelta(hours=1))
+
+    assert len(snapshot) == 7
+    assert buckets.positive.tolist() == [1, 1]
+    assert buckets.negative.tolist() == [1, 1]
+    assert buckets.invalid.tolist() == [0, 0]
+
+
+def test_hourly_buckets(snapshot: PositivitySnapshot, start: datetime) -> None:
+    buckets = snapshot.buckets(start, start + timedelta(hours=4), timedelta(hours=1))
+
+    assert [int(s) for s in buckets.starts] == [
+        int((start + timedelta(hours=hour)).timestamp()) for hour in range(4)
+    ]
+    assert buckets.positive.tolist() == [1, 0, 2, 0]
+    assert buckets.negative.tolist() == [1, 1, 0, 0]
+    assert buckets.invalid.tolist() == [1, 0, 0, 0]
+    assert buckets.rate[:3].tolist() == [0.5, 0.0, 1.0]
+    assert math.isnan(buckets.rate[3])
+
+
+def test_rolling_window(snapshot: PositivitySnapshot, start: datetime) -> None:
+    buckets = snapshot.buckets(
+        start + timedelta(hours=1),
+        start + timedelta(hours=6),
+        timedelta(hours=1),
+        window=2,
+    )
+
+    assert buckets.positive.tolist() == [1, 2, 2, 0, 0]
+    assert buckets.negative.tolist() == [2, 1, 0, 0, 1]
+    assert buckets.invalid.tolist() == [1, 0, 0, 0, 0]
+
+
+def test_daily_buckets(snapshot: PositivitySnapshot, start: datetime) -> None:
+    buckets = snapshot.buckets(start, start + timedelta(days=2), timedelta(days=1))
+
+    assert buckets.positive.tolist() == [3, 0]
+    assert buckets.negative.tolist() == [3, 0]
+    assert buckets.invalid.tolist() == [1, 0]
@@ -0,0 +1,124 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Any, AsyncIterator, Iterable, cast
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from example.domain.booking import Client, EventListener, Order
+from example.infrastructure import group_commit
+from example.infrastructure.group_commit import OrderBatcher
+
+
+class FakeDatabase:
+    batches: list[list[str]] = []
+    fail = False
+
+    def __init__(self, *args: Any) -> None:
+        pass
+
+    async def insert_orders(self, orders: Iterable[Order]) -> None:
+        FakeDatabase.batches.append([order.client.id for order in orders])
+        if FakeDatabase.fail:
+            raise RuntimeError("commit failed")
+
+
+class FailingClient(Client):
+    def create_order(self, order_id: str, listener: EventListener) -> Order:
+        raise ValueError(self.id)
+
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch: pytest.MonkeyPatch) -> None:
+    FakeDatabase.batches = []
+    FakeDatabase.fail = False
+    monkeypatch.setattr(group_commit, "Database", FakeDatabase)
+
+
+@pytest.fixture
+def order_batcher() -> OrderBatcher:
+    session = MagicMock()
+    session.__aenter__ = AsyncMock(return_value=session)
+    session.__aexit__ = AsyncMock(return_value=None)
+    mongo_client = MagicMock()
+    mongo_client.start_session = AsyncMock(return_value=session)
+
+    @asynccontextmanager
+    async def event_listener(session: Any) -> AsyncIterator[MagicMock]:
+        yield MagicMock()
+
+    outbox = MagicMock()
+    outbox.event_listener = event_listener
+    return OrderBatcher(
+        mongo_client,
+        outbox,
+        window=timedelta(milliseconds=5),
+        max_batch_size=4,
+    )
+
+
+async def test_concurrent_orders_are_merged(order_batcher: OrderBatcher) -> None:
+    client_ids = [str(i) for i in range(10)]
+
+    orders = await asyncio.gather(
+        *(order_batcher.create_order(Client(client_id)) for client_id in client_ids)
+    )
+
+    assert [order.client.id for order in orders] == client_ids
+    assert FakeDatabase.batches == [client_ids[:4], client_ids[4:8], client_ids[8:]]
+
+
+async def test_each_caller_gets_own_error(order_batcher: OrderBatcher) -> None:
+    results = await asyncio.gather(
+        order_batcher.create_order(FailingClient("bad")),
+        order_batcher.create_order(Client("good")),
+        return_exceptions=True,
+    )
+
+    assert isinstance(results[0], ValueError)
+    assert isinstance(results[1], Order)
+    assert FakeDatabase.batches == [["good"]]
+
+
+async def test_failed_commit_fails_whole_batch(order_batcher: OrderBatcher) -> None:
+    FakeDatabase.fail = True
+
+    results = await asyncio.gather(
+        order_batcher.create_order(Client("1")),
+        order_batcher.create_order(Client("2")),
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+async def test_failed_session_fails_whole_batch(
+    order_batcher: OrderBatcher,
+) -> None:
+    start_session = cast(AsyncMock, order_batcher.mongo_client.start_session)
+    start_session.side_effect = RuntimeError("no session")
+
+    results = await asyncio.wait_for(
+        asyncio.gather(
+            order_batcher.create_order(Client("1")),
+            order_batcher.create_order(Client("2")),
+            return_exceptions=True,
+        ),
+        timeout=1,
+    )
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert FakeDatabase.batches == []
+
+
+async def test_cancelled_caller_gets_no_order(order_batcher: OrderBatcher) -> None:
+    cancelled = asyncio.create_task(order_batcher.create_order(Client("gone")))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+
+    order = await order_batcher.create_order(Client("waiting"))
+
+    assert order.client.id == "waiting"
+    assert FakeDatabase.batches == [["waiting"]]
+    await order_batcher.aclose()
@@ -0,0 +1,61 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+from example.infrastructure.profiling import SamplingProfiler
+
+
+def busy() -> None:
+    deadline = time.monotonic() + 0.1
+    while time.monotonic() < deadline:
+        pass
+
+
+@pytest.fixture
+def profiler() -> SamplingProfiler:
+    return SamplingProfiler(
+        enabled=True,
+        sample_rate=1,
+        interval=timedelta(milliseconds=1),
+        max_depth=64,
+        max_stacks=100,
+    )
+
+
+async def test_sampled_stacks_are_aggregated(profiler: SamplingProfiler) -> None:
+    with profiler.profile("GET /test"):
+        busy()
+    profiler.close()
+
+    folded = [line.rsplit(" ", 1) for line in profiler.folded_stacks().splitlines()]
+    assert folded
+    assert all(stack.startswith("GET /test;") for stack, _ in folded)
+    assert all(int(samples) > 0 for _, samples in folded)
+    assert any(stack.endswith(f"{__name__}:busy") for stack, _ in folded)
+
+    (frame, samples, ratio), *_ = profiler.hot_frames(1)
+    assert frame == f"{__name__}:busy"
+    assert ratio == samples / sum(int(samples) for _, samples in folded)
+
+
+async def test_unsampled_invocations_are_not_recorded(
+    profiler: SamplingProfiler,
+) -> None:
+    profiler.sample_rate = 0
+    with profiler.profile("GET /test"):
+        busy()
+    profiler.close()
+
+    assert profiler.folded_stacks() == ""
+    assert profiler.hot_frames(5) == []
+
+
+async def test_reset(profiler: SamplingProfiler) -> None:
+    with profiler.profile("GET /test"):
+        busy()
+    profiler.close()
+
+    profiler.reset()
+
+    assert profiler.folded_stacks() == ""
@@ -1,12 +1,18 @@
 import asyncio
-from typing import AsyncIterator
+from typing import AsyncIterator, Iterable, Iterator, cast
 
 import pytest
 from asgi_lifespan import LifespanManager
-from httpx import ASGITransport, AsyncClient
+from bson import ObjectId
+from httpx import ASGITransport, AsyncClient, Response
+from motor.motor_asyncio import AsyncIOMotorClient
 
+from example.domain.booking import Client, EventListener, Order
 from example.domain.rapid_testing import RapidTestResult
-from example.infrastructure.http_server import config, create_app
+from example.infrastructure.config import config
+from example.infrastructure.database import Database
+from example.infrastructure.http_server import create_app
+from example.infrastructure.replay import replay
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -14,6 +20,13 @@ def set_test_environment() -> None:
     config.configure(FORCE_ENV_FOR_DYNACONF="test")
 
 
+@pytest.fixture
+def group_commit() -> Iterator[None]:
+    config.set("booking.group_commit.enabled", True)
+    yield
+    config.set("booking.group_commit.enabled", False)
+
+
 @pytest.fixture
 async def http_client() -> AsyncIterator[AsyncClient]:
     async with LifespanManager(create_app()) as manager:
@@ -26,6 +39,15 @@ async def http_client() -> AsyncIterator[AsyncClient]:
             yield http_client
 
 
+@pytest.fixture
+async def mongo_client() -> AsyncIterator[AsyncIOMotorClient]:
+    mongo_client: AsyncIOMotorClient = AsyncIOMotorClient(
+        config.mongo.connection_string, tz_aware=True
+    )
+    yield mongo_client
+    mongo_client.close()
+
+
 async def test_main_flow(http_client: AsyncClient) -> None:
     client_id = "yura"
 
@@ -41,6 +63,12 @@ async def test_main_flow(http_client: AsyncClient) -> None:
     assert response.status_code == 200
     assert response.json() == order
 
+    response = await http_client.get(
+        f"/orders/{order_id}",
+        headers={"If-None-Match": response.headers["etag"]},
+    )
+    assert response.status_code == 304
+
     response = await http_client.post(
         f"/orders/{order_id}/sample",
         json={"sample_id": "R31337"},
@@ -55,7 +83,253 @@ async def test_main_flow(http_client: AsyncClient) -> None:
     )
     assert response.status_code == 200
 
+    await asyncio.sleep(2)
+
+    response = await http_client.get(f"/client/{client_id}/orders/{order_id}/report")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/html")
+    report = response.content
+    assert order_id.encode() in report
+
+    response = await http_client.get(
+        f"/client/{client_id}/orders/{order_id}/report",
+        headers={"Range": "bytes=0-14"},
+    )
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 0-14/{len(report)}"
+    assert response.content == report[:15]
+
+    response = await http_client.get(
+        f"/client/{client_id}/orders/{order_id}/report",
+        headers={"If-None-Match": response.headers["etag"]},
+    )
+    assert response.status_code == 304
+
+
+async def test_replay(
+    http_client: AsyncClient, mongo_client: AsyncIOMotorClient
+) -> None:
+    client_id = "yura"
+
+    response = await http_client.post(f"/client/{client_id}/orders")
+    order_id = response.json()["id"]
+
     await asyncio.sleep(1)
 
+    await http_client.post(
+        f"/orders/{order_id}/sample",
+        json={"sample_id": "R31337"},
+    )
+    await http_client.post(
+        f"/orders/{order_id}/result",
+        json={"result": RapidTestResult.NEGATIVE},
+    )
+
+    await asyncio.sleep(3)
+
+    db = mongo_client.get_default_database()
+    await db["rapid_tests"].delete_one({"order_id": ObjectId(order_id)})
+    await db["diagnostic_reports"].delete_one({"order_id": ObjectId(order_id)})
+
+    await replay()
+
+    rapid_test = await db["rapid_tests"].find_one({"order_id": ObjectId(order_id)})
+    assert rapid_test
+    assert rapid_test["client_id"] == client_id
+    assert rapid_test["sample_id"] == "R31337"
+    assert rapid_test["result"] == RapidTestResult.NEGATIVE
+
     response = await http_client.get(f"/client/{client_id}/orders/{order_id}/report")
     assert response.status_code == 200
+
+
+async def test_group_commit(
+    group_commit: None, http_client: AsyncClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    batch_sizes = []
+    insert_orders = Database.insert_orders
+
+    async def spy_insert_orders(self: Database, orders: Iterable[Order]) -> None:
+        orders = list(orders)
+        batch_sizes.append(len(orders))
+        await insert_orders(self, orders)
+
+    create_order = Client.create_order
+
+    def failing_create_order(
+        self: Client, order_id: str, listener: EventListener
+    ) -> Order:
+        if self.id == "client-bad":
+            raise ValueError(self.id)
+        return create_order(self, order_id, listener)
+
+    monkeypatch.setattr(Database, "insert_orders", spy_insert_orders)
+    monkeypatch.setattr(Client, "create_order", failing_create_order)
+
+    client_ids = [f"client-{i}" for i in range(10)]
+
+    bad_response, *responses = await asyncio.gather(
+        http_client.post("/client/client-bad/orders"),
+        *(http_client.post(f"/client/{client_id}/orders") for client_id in client_ids),
+        return_exceptions=True,
+    )
+    assert isinstance(bad_response, ValueError)
+    assert all(
+        isinstance(response, Response) and response.status_code == 200
+        for response in responses
+    )
+    orders = [cast(Response, response).json() for response in responses]
+    assert [order["client_id"] for order in orders] == client_ids
+    assert len({order["id"] for order in orders}) == len(orders)
+    # Concurrent requests were merged into fewer transactions
+    assert sum(batch_sizes) == len(client_ids)
+    assert len(batch_sizes) < len(client_ids)
+
+    for order in orders:
+        response = await http_client.get(f"/orders/{order['id']}")
+        assert response.status_code == 200
+        assert response.json() == order
+
+
+async def test_profiling(http_client: AsyncClient) -> None:
+    response = await http_client.get("/admin/profiling")
+    assert response.status_code == 401
+
+    http_client.headers["Authorization"] = f"Bearer {config.admin.token}"
+
+    response = await http_client.put(
+        "/admin/profiling",
+        json={"enabled": True, "sample_rate": 1},
+    )
+    assert response.status_code == 200
+
+    response = await http_client.post("/client/yura/orders")
+    assert response.status_code == 200
+    order_id = response.json()["id"]
+
+    label = "GET /orders/{order_id};"
+    for _ in range(20):
+        response = await http_client.get(f"/orders/{order_id}")
+        assert response.status_code == 200
+        response = await http_client.get("/admin/profiling/flamegraph")
+        assert response.status_code == 200
+        if label in response.text:
+            break
+    lines = response.text.splitlines()
+    assert any(line.startswith(label) for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+    response = await http_client.get("/admin/profiling/hot-frames?limit=5")
+    assert response.status_code == 200
+    hot_frames = response.json()
+    assert 0 < len(hot_frames) <= 5
+    assert all(hot_frame["samples"] > 0 for hot_frame in hot_frames)
+
+    await http_client.put(
+        "/admin/profiling",
+        json={"enabled": False, "sample_rate": 1},
+    )
+    response = await http_client.delete("/admin/profiling/samples")
+    assert response.status_code == 200
+    response = await http_client.get("/admin/profiling/flamegraph")
+    assert response.text == ""
+
+
+async def test_client_stats(http_client: AsyncClient) -> None:
+    client_id = f"clinic-{ObjectId()}"
+
+    response = await http_client.get(f"/client/{client_id}/stats")
+    assert response.status_code == 200
+    assert response.json() == {
+        "orders": 0,
+        "samples_collected": 0,
+        "positive": 0,
+        "negative": 0,
+        "invalid": 0,
+    }
+
+    order_ids = []
+    for _ in range(2):
+        response = await http_client.post(f"/client/{client_id}/orders")
+        order_ids.append(response.json()["id"])
+
+    await asyncio.sleep(1)
+
+    for order_id in order_ids:
+        await http_client.post(
+            f"/orders/{order_id}/sample",
+            json={"sample_id": "R31337"},
+        )
+    await http_client.post(
+        f"/orders/{order_ids[0]}/result",
+        json={"result": RapidTestResult.INVALID},
+    )
+    await http_client.post(
+        f"/orders/{order_ids[0]}/result",
+        json={"result": RapidTestResult.POSITIVE},
+    )
+
+    await asyncio.sleep(1)
+
+    response = await http_client.get(f"/client/{client_id}/stats")
+    assert response.status_code == 200
+    assert response.json() == {
+        "orders": 2,
+        "samples_collected": 2,
+        "positive": 1,
+        "negative": 0,
+        "invalid": 0,
+    }
+
+    # The report is generated again for the corrected result
+    response = await http_client.get(
+        f"/client/{client_id}/orders/{order_ids[0]}/report"
+    )
+    assert response.status_code == 200
+    assert RapidTestResult.POSITIVE.encode() in response.content
+    assert RapidTestResult.INVALID.encode() not in response.content
+
+
+async def test_concurrent_orders_of_one_client(http_client: AsyncClient) -> None:
+    client_id = f"clinic-{ObjectId()}"
+
+    responses = await asyncio.gather(
+        *(http_client.post(f"/client/{client_id}/orders") for _ in range(10))
+    )
+    assert all(response.status_code == 200 for response in responses)
+
+    await asyncio.sleep(1)
+
+    response = await http_client.get(f"/client/{client_id}/stats")
+    assert response.json()["orders"] == 10
+
+
+async def test_positivity(http_client: AsyncClient) -> None:
+    response = await http_client.post("/client/yura/orders")
+    order_id = response.json()["id"]
+
+    await asyncio.sleep(1)
+
+    await http_client.post(
+        f"/orders/{order_id}/result",
+        json={"result": RapidTestResult.POSITIVE},
+    )
+
+    await asyncio.sleep(1)
+
+    response = await http_client.get(
+        "/analytics/positivity",
+        params={"bucket": "hour", "window": 24},
+    )
+    assert response.status_code == 200
+    positivity = response.json()
+    assert positivity["complete"]
+    assert len(positivity["buckets"]) == 30
+    assert positivity["buckets"][-1]["positive"] >= 1
+    assert positivity["buckets"][-1]["rate"] > 0
+
+    response = await http_client.get(
+        "/analytics/positivity",
+        params={"start": "2024-06-01T00:00:00", "end": "2024-06-02T00:00:00"},
+    )
+    assert response.status_code == 422